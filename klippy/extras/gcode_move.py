@@ -106,6 +106,8 @@ class GCodeMove:
             'position': self.Coord(*self.last_position),
             'gcode_position': self.Coord(*move_position),
         }
+    def get_extrude_info(self):
+        return self.last_position[3], self.extrude_factor
     def reset_last_position(self):
         if self.is_printer_ready:
             self.last_position = self.position_with_transform()
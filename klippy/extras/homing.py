@@ -67,7 +67,7 @@ class HomingMove:
     def homing_move(self, movepos, speed, probe_pos=False,
                     triggered=True, check_triggered=True):
         # Notify start of homing/probing move
-        self.printer.send_event("homing:homing_move_begin", self)
+        self.printer.fire_event("homing:homing_move_begin", self)
         # Note start location
         self.toolhead.flush_step_generation()
         kin = self.toolhead.get_kinematics()
@@ -129,7 +129,7 @@ class HomingMove:
         self.toolhead.set_position(haltpos)
         # Signal homing/probing move complete
         try:
-            self.printer.send_event("homing:homing_move_end", self)
+            self.printer.fire_event("homing:homing_move_end", self)
         except self.printer.command_error as e:
             if error is None:
                 error = str(e)
@@ -171,7 +171,7 @@ class Homing:
         self.toolhead.set_position(self._fill_coord(pos))
     def home_rails(self, rails, forcepos, movepos):
         # Notify of upcoming homing operation
-        self.printer.send_event("homing:home_rails_begin", self, rails)
+        self.printer.fire_event("homing:home_rails_begin", self, rails)
         # Alter kinematics class to think printer is at forcepos
         homing_axes = [axis for axis in range(3) if forcepos[axis] is not None]
         startpos = self._fill_coord(forcepos)
@@ -208,7 +208,7 @@ class Homing:
         self.trigger_mcu_pos = {sp.stepper_name: sp.trig_pos
                                 for sp in hmove.stepper_positions}
         self.adjust_pos = {}
-        self.printer.send_event("homing:home_rails_end", self, rails)
+        self.printer.fire_event("homing:home_rails_end", self, rails)
         if any(self.adjust_pos.values()):
             # Apply any homing offsets
             kin = self.toolhead.get_kinematics()
@@ -54,7 +54,7 @@ class IdleTimeout:
             return eventtime + 1.
         print_time = self.toolhead.get_last_move_time()
         self.state = "Idle"
-        self.printer.send_event("idle_timeout:idle", print_time)
+        self.printer.fire_event("idle_timeout:idle", print_time)
         return self.reactor.NEVER
     def check_idle_timeout(self, eventtime):
         # Make sure toolhead class isn't busy
@@ -100,7 +100,7 @@ class IdleTimeout:
             return eventtime + READY_TIMEOUT
         # Transition to "ready" state
         self.state = "Ready"
-        self.printer.send_event("idle_timeout:ready",
+        self.printer.fire_event("idle_timeout:ready",
                                 est_print_time + PIN_MIN_TIME)
         logging.info("------------------------------102:self.is_idle_timeout = False")
         self.is_idle_timeout = False
@@ -113,7 +113,7 @@ class IdleTimeout:
         self.last_print_start_systime = curtime
         check_time = READY_TIMEOUT + print_time - est_print_time
         self.reactor.update_timer(self.timeout_timer, curtime + check_time)
-        self.printer.send_event("idle_timeout:printing",
+        self.printer.fire_event("idle_timeout:printing",
                                 est_print_time + PIN_MIN_TIME)
     cmd_SET_IDLE_TIMEOUT_help = "Set the idle timeout in seconds"
     def cmd_SET_IDLE_TIMEOUT(self, gcmd):
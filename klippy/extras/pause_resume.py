@@ -4,34 +4,46 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
+_MSG_ALREADY_PAUSED = """{"code":"key211", "msg": "Print already paused", "values": []}"""
+_MSG_NOT_PAUSED = """{"code": "key16", "msg": "Print is not paused, resume aborted"}"""
+
+# State flags
+_F_PAUSED, _F_SD_PAUSED, _F_CMD_SENT = 1, 2, 4
+
+# Shared get_status() results (callers must not modify them)
+_STATUS_PAUSED = {'is_paused': True}
+_STATUS_NOT_PAUSED = {'is_paused': False}
+
 class PauseResume:
+    _RESUME_SCRIPT = (
+        "RESTORE_GCODE_STATE STATE=PAUSE_STATE MOVE=1 MOVE_SPEED=%.4f")
     def __init__(self, config):
         self.printer = config.get_printer()
         self.gcode = self.printer.lookup_object('gcode')
         self.recover_velocity = config.getfloat('recover_velocity', 50.)
         self.v_sd = None
-        self.is_paused = False
-        self.sd_paused = False
-        self.pause_command_sent = False
+        self._v_sd_is_active = (lambda: False)
+        self._flags = 0
         self.printer.register_event_handler("klippy:connect",
                                             self.handle_connect)
-        self.gcode.register_command("PAUSE", self.cmd_PAUSE,
-                                    desc=self.cmd_PAUSE_help)
-        self.gcode.register_command("RESUME", self.cmd_RESUME,
-                                    desc=self.cmd_RESUME_help)
-        self.gcode.register_command("CLEAR_PAUSE", self.cmd_CLEAR_PAUSE,
-                                    desc=self.cmd_CLEAR_PAUSE_help)
-        self.gcode.register_command("CANCEL_PRINT", self.cmd_CANCEL_PRINT,
-                                    desc=self.cmd_CANCEL_PRINT_help)
+        for cmd, func, desc in [
+                ("PAUSE", self.cmd_PAUSE, self.cmd_PAUSE_help),
+                ("RESUME", self.cmd_RESUME, self.cmd_RESUME_help),
+                ("CLEAR_PAUSE", self.cmd_CLEAR_PAUSE,
+                 self.cmd_CLEAR_PAUSE_help),
+                ("CANCEL_PRINT", self.cmd_CANCEL_PRINT,
+                 self.cmd_CANCEL_PRINT_help)]:
+            self.gcode.register_command(cmd, func, desc=desc)
         webhooks = self.printer.lookup_object('webhooks')
-        webhooks.register_endpoint("pause_resume/cancel",
-                                   self._handle_cancel_request)
-        webhooks.register_endpoint("pause_resume/pause",
-                                   self._handle_pause_request)
-        webhooks.register_endpoint("pause_resume/resume",
-                                   self._handle_resume_request)
+        for path, callback in [
+                ("pause_resume/cancel", self._handle_cancel_request),
+                ("pause_resume/pause", self._handle_pause_request),
+                ("pause_resume/resume", self._handle_resume_request)]:
+            webhooks.register_endpoint(path, callback)
     def handle_connect(self):
         self.v_sd = self.printer.lookup_object('virtual_sdcard', None)
+        if self.v_sd is not None:
+            self._v_sd_is_active = self.v_sd.is_active
     def _handle_cancel_request(self, web_request):
         self.gcode.run_script("CANCEL_PRINT")
     def _handle_pause_request(self, web_request):
@@ -39,58 +51,56 @@ class PauseResume:
     def _handle_resume_request(self, web_request):
         self.gcode.run_script("RESUME")
     def get_status(self, eventtime):
-        return {
-            'is_paused': self.is_paused
-        }
+        if self._flags & _F_PAUSED:
+            return _STATUS_PAUSED
+        return _STATUS_NOT_PAUSED
     def is_sd_active(self):
-        return self.v_sd is not None and self.v_sd.is_active()
+        return self._v_sd_is_active()
     def send_pause_command(self):
         # This sends the appropriate pause command from an event.  Note
-        # the difference between pause_command_sent and is_paused, the
+        # the difference between _F_CMD_SENT and _F_PAUSED, the
         # module isn't officially paused until the PAUSE gcode executes.
-        if not self.pause_command_sent:
+        if not self._flags & _F_CMD_SENT:
             if self.is_sd_active():
                 # Printing from virtual sd, run pause command
-                self.sd_paused = True
+                self._flags |= _F_SD_PAUSED
                 self.v_sd.do_pause()
             else:
-                self.sd_paused = False
+                self._flags &= ~_F_SD_PAUSED
                 self.gcode.respond_info("action:paused")
-            self.pause_command_sent = True
+            self._flags |= _F_CMD_SENT
     cmd_PAUSE_help = ("Pauses the current print")
     def cmd_PAUSE(self, gcmd):
-        if self.is_paused:
-            gcmd.respond_info("""{"code":"key211", "msg": "Print already paused", "values": []}""")
+        if self._flags & _F_PAUSED:
+            gcmd.respond_info(_MSG_ALREADY_PAUSED)
             return
         self.send_pause_command()
         self.gcode.run_script_from_command("SAVE_GCODE_STATE STATE=PAUSE_STATE")
-        self.is_paused = True
+        self._flags |= _F_PAUSED
     def send_resume_command(self):
-        if self.sd_paused:
+        if self._flags & _F_SD_PAUSED:
             # Printing from virtual sd, run pause command
             self.v_sd.do_resume()
-            self.sd_paused = False
+            self._flags &= ~_F_SD_PAUSED
         else:
             self.gcode.respond_info("action:resumed")
-        self.pause_command_sent = False
+        self._flags &= ~_F_CMD_SENT
     cmd_RESUME_help = ("Resumes the print from a pause")
     def cmd_RESUME(self, gcmd):
-        if not self.is_paused:
-            gcmd.respond_info("""{"code": "key16", "msg": "Print is not paused, resume aborted"}""")
+        if not self._flags & _F_PAUSED:
+            gcmd.respond_info(_MSG_NOT_PAUSED)
             return
         velocity = gcmd.get_float('VELOCITY', self.recover_velocity)
-        self.gcode.run_script_from_command(
-            "RESTORE_GCODE_STATE STATE=PAUSE_STATE MOVE=1 MOVE_SPEED=%.4f"
-            % (velocity))
+        self.gcode.run_script_from_command(self._RESUME_SCRIPT % (velocity,))
         self.send_resume_command()
-        self.is_paused = False
+        self._flags &= ~_F_PAUSED
     cmd_CLEAR_PAUSE_help = (
         "Clears the current paused state without resuming the print")
     def cmd_CLEAR_PAUSE(self, gcmd):
-        self.is_paused = self.pause_command_sent = False
+        self._flags &= ~(_F_PAUSED | _F_CMD_SENT)
     cmd_CANCEL_PRINT_help = ("Cancel the current print")
     def cmd_CANCEL_PRINT(self, gcmd):
-        if self.is_sd_active() or self.sd_paused:
+        if self.is_sd_active() or self._flags & _F_SD_PAUSED:
             self.v_sd.do_cancel()
         else:
             gcmd.respond_info("action:cancel")
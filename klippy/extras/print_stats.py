@@ -3,50 +3,64 @@
 # Copyright (C) 2020  Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
+import os, errno, logging
 
 class PrintStats:
     def __init__(self, config):
         printer = config.get_printer()
         self.gcode_move = printer.load_object(config, 'gcode_move')
         self.reactor = printer.get_reactor()
+        self._monotonic = self.reactor.monotonic
         self.reset()
         if printer.start_args.get("apiserver")[-1] != "s":
             self.index = printer.start_args.get("apiserver")[-1]
         else:
             self.index = "1"
-        self.last_new_total_print_time = self.last_total_print_time = self.new_total_print_time = self.get_last_total_print_time()
+        self._totaltime_path = (
+            '/mnt/UDISK/.crealityprint/printer%s_totaltime' % self.index)
+        self._last_total_print_time_cached = None
+        self._write_failed = False
+        # Coalesce writes of the total print time to flash
+        self._last_write_time = 0.
+        self._load_total_time()
+    def _load_total_time(self):
+        total = self.get_last_total_print_time()
+        self.last_total_print_time = self.new_total_print_time = total
+        self._last_written_minutes = total
     def _update_filament_usage(self, eventtime):
-        gc_status = self.gcode_move.get_status(eventtime)
-        cur_epos = gc_status['position'].e
-        self.filament_used += (cur_epos - self.last_epos) \
-            / gc_status['extrude_factor']
+        cur_epos, extrude_factor = self.gcode_move.get_extrude_info()
+        self.filament_used += (cur_epos - self.last_epos) / extrude_factor
         self.last_epos = cur_epos
+        if not self._extruded and self.filament_used >= 0.0000001:
+            self._extruded = True
     def set_current_file(self, filename):
         self.reset()
         self.filename = filename
+        self._idle_status_cache = None
     def note_start(self):
-        curtime = self.reactor.monotonic()
+        curtime = self._monotonic()
         if self.print_start_time is None:
             self.print_start_time = curtime
+            # New print - accumulate on top of the stored total
+            self._load_total_time()
         elif self.last_pause_time is not None:
             # Update pause time duration
             pause_duration = curtime - self.last_pause_time
             self.prev_pause_duration += pause_duration
             self.last_pause_time = None
         # Reset last e-position
-        gc_status = self.gcode_move.get_status(curtime)
-        self.last_epos = gc_status['position'].e
+        self.last_epos = self.gcode_move.get_extrude_info()[0]
         self.state = "printing"
         self.error_message = ""
-        self.last_new_total_print_time = self.last_total_print_time = self.new_total_print_time = self.get_last_total_print_time()
     def note_pause(self):
         if self.last_pause_time is None:
-            curtime = self.reactor.monotonic()
+            curtime = self._monotonic()
             self.last_pause_time = curtime
             # update filament usage
             self._update_filament_usage(curtime)
         if self.state != "error":
             self.state = "paused"
+        self._idle_status_cache = None
     def note_complete(self):
         self._note_finish("complete")
     def note_error(self, message):
@@ -58,13 +72,19 @@ class PrintStats:
             return
         self.state = state
         self.error_message = error_message
-        eventtime = self.reactor.monotonic()
+        eventtime = self._monotonic()
         self.total_duration = eventtime - self.print_start_time
-        if self.filament_used < 0.0000001:
+        if not self._extruded:
             # No positive extusion detected during print
             self.init_duration = self.total_duration - \
                 self.prev_pause_duration
         self.print_start_time = None
+        self._idle_status_cache = None
+        # Flush any total print time held back by write coalescing
+        if self.new_total_print_time > self._last_written_minutes:
+            self._last_write_time = eventtime
+            if self.set_total_print_time(self.new_total_print_time):
+                self._last_written_minutes = self.new_total_print_time
     def reset(self):
         self.filename = self.error_message = ""
         self.state = "standby"
@@ -72,7 +92,13 @@ class PrintStats:
         self.filament_used = self.total_duration = 0.
         self.print_start_time = self.last_pause_time = None
         self.init_duration = 0.
+        self._extruded = False
+        self._idle_status_cache = None
     def get_status(self, eventtime):
+        if (self.print_start_time is None
+            and self._idle_status_cache is not None):
+            # Nothing changes until the next print starts
+            return self._idle_status_cache
         time_paused = self.prev_pause_duration
         if self.print_start_time is not None:
             if self.last_pause_time is not None:
@@ -82,16 +108,20 @@ class PrintStats:
                 # Accumulate filament if not paused
                 self._update_filament_usage(eventtime)
             self.total_duration = eventtime - self.print_start_time
-            if self.filament_used < 0.0000001:
+            if not self._extruded:
                 # Track duration prior to extrusion
                 self.init_duration = self.total_duration - time_paused
         print_duration = self.total_duration - self.init_duration - time_paused
-        self.new_total_print_time = print_duration/60 + self.last_total_print_time
-        if self.new_total_print_time > self.last_new_total_print_time:
-            self.set_total_print_time(self.new_total_print_time)
-            self.last_new_total_print_time = self.new_total_print_time
-            # self.last_total_print_time = self.new_total_print_time
-        return {
+        # Total print time is tracked in whole minutes
+        new_minutes = int(print_duration) // 60 + self.last_total_print_time
+        if new_minutes > self._last_written_minutes:
+            self.new_total_print_time = new_minutes
+            if eventtime - self._last_write_time > 30.:
+                # Throttle failed writes as well as successful ones
+                self._last_write_time = eventtime
+                if self.set_total_print_time(new_minutes):
+                    self._last_written_minutes = new_minutes
+        status = {
             'filename': self.filename,
             'total_duration': self.total_duration,
             'print_duration': print_duration,
@@ -99,20 +129,53 @@ class PrintStats:
             'state': self.state,
             'message': self.error_message
         }
+        if self.print_start_time is None and self.state in (
+                "standby", "complete", "cancelled", "error"):
+            self._idle_status_cache = status
+        return status
 
     def get_last_total_print_time(self):
+        if self._last_total_print_time_cached is None:
+            self._last_total_print_time_cached = self._read_total_print_time()
+        return self._last_total_print_time_cached
+
+    def _read_total_print_time(self):
         try:
-            with open('/mnt/UDISK/.crealityprint/printer%s_totaltime' % self.index) as f:
+            with open(self._totaltime_path, 'rb') as f:
                 return int(f.read())
-        except:
-            return 0
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                logging.warning("Unable to read %s: %s",
+                                self._totaltime_path, e)
+        except ValueError as e:
+            logging.warning("Invalid total print time in %s: %s",
+                            self._totaltime_path, e)
+        return 0
 
     def set_total_print_time(self, new_total_print_time):
+        # Write to a temporary file and rename it into place so that a
+        # power loss can not leave behind a truncated file
+        tmp_path = self._totaltime_path + ".tmp"
         try:
-            with open('/mnt/UDISK/.crealityprint/printer%s_totaltime' % self.index, "w+") as f:
+            with open(tmp_path, "w") as f:
                 f.write(str(int(new_total_print_time)))
-        except:
-            pass
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self._totaltime_path)
+        except (IOError, OSError) as e:
+            # Only report the first failure until a write succeeds
+            if not self._write_failed:
+                logging.warning("Unable to write %s: %s",
+                                self._totaltime_path, e)
+                self._write_failed = True
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        self._write_failed = False
+        self._last_total_print_time_cached = int(new_total_print_time)
+        return True
 
 def load_config(config):
     return PrintStats(config)
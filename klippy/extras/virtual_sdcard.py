@@ -3,10 +3,13 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, time, logging, collections, threading
+import util
 
-VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
+VALID_GCODE_EXTS = frozenset(['gcode', 'g', 'gco'])
 LAYER_KEYS = [";LAYER", "; layer", "; LAYER", ";AFTER_LAYER_CHANGE"]
+LAYER_PREFIXES = tuple(LAYER_KEYS)
+TIMELAPSE_CONFIG = "/mnt/UDISK/.crealityprint/time_lapse.yaml"
 
 class VirtualSD:
     def __init__(self, config):
@@ -18,6 +21,7 @@ class VirtualSD:
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
         self.current_file = None
         self.file_position = self.file_size = 0
+        self._flist_cache = {}
         # Print Stat Tracking
         self.print_stats = printer.load_object(config, 'print_stats')
         # Work timer
@@ -25,6 +29,8 @@ class VirtualSD:
         self.must_pause_work = self.cmd_from_sd = False
         self.next_file_position = 0
         self.work_timer = None
+        self.pause_completion = None
+        self.timelapse_config = None
         if printer.start_args.get("apiserver")[-1] != "s":
             self.index = printer.start_args.get("apiserver")[-1]
         else:
@@ -60,31 +66,69 @@ class VirtualSD:
         if self.work_timer is None:
             return False, ""
         return True, "sd_pos=%d" % (self.file_position,)
-    def get_file_list(self, check_subdirs=False):
+    def _get_dir_mtime(self, check_subdirs, dirpath=None):
+        if dirpath is None:
+            dirpath = self.sdcard_dirname
+        mtime = os.stat(dirpath).st_mtime
         if check_subdirs:
-            flist = []
-            for root, dirs, files in os.walk(
-                    self.sdcard_dirname, followlinks=True):
-                for name in files:
-                    ext = name[name.rfind('.')+1:]
-                    if ext not in VALID_GCODE_EXTS:
-                        continue
-                    full_path = os.path.join(root, name)
-                    r_path = full_path[len(self.sdcard_dirname) + 1:]
-                    size = os.path.getsize(full_path)
-                    flist.append((r_path, size))
-            return sorted(flist, key=lambda f: f[0].lower())
-        else:
-            dname = self.sdcard_dirname
+            for entry in list(util.scandir(dirpath)):
+                if entry.is_dir():
+                    mtime = max(mtime, self._get_dir_mtime(True, entry.path))
+        return mtime
+    def get_file_list(self, check_subdirs=False):
+        # Reuse the last file names if no directory has changed since.
+        # Files may be rewritten in place, so sizes are always re-read.
+        try:
+            mtime = self._get_dir_mtime(check_subdirs)
+        except OSError:
+            mtime = None
+        cached_mtime, names = self._flist_cache.get(check_subdirs, (None, []))
+        if mtime is not None and mtime == cached_mtime:
+            return self._get_file_sizes(names)
+        flist = self._build_file_list(check_subdirs)
+        # Directory mtimes may be coarse (eg, 2 seconds on FAT), so only
+        # trust the cache once the directory has been stable for a while
+        if mtime is not None and time.time() - mtime > 2.:
+            self._flist_cache[check_subdirs] = (
+                mtime, [fname for fname, fsize in flist])
+        return flist
+    def _get_file_sizes(self, names):
+        flist = []
+        for fname in names:
             try:
-                filenames = os.listdir(self.sdcard_dirname)
-                return [(fname, os.path.getsize(os.path.join(dname, fname)))
-                        for fname in sorted(filenames, key=str.lower)
-                        if not fname.startswith('.')
-                        and os.path.isfile((os.path.join(dname, fname)))]
-            except:
-                logging.exception("virtual_sdcard get_file_list")
-                raise self.gcode.error("Unable to get file list")
+                st = os.stat(os.path.join(self.sdcard_dirname, fname))
+            except OSError:
+                continue
+            flist.append((fname, st.st_size))
+        return flist
+    def _scan_dir(self, dirpath, check_subdirs, flist, prefix=""):
+        for entry in list(util.scandir(dirpath)):
+            name = entry.name
+            # Skip entries that can not be read (eg, broken symlinks)
+            try:
+                if check_subdirs:
+                    if entry.is_dir():
+                        self._scan_dir(entry.path, True, flist,
+                                       os.path.join(prefix, name))
+                        continue
+                    if name[name.rfind('.')+1:] not in VALID_GCODE_EXTS:
+                        continue
+                elif name.startswith('.') or not entry.is_file():
+                    continue
+                size = entry.stat().st_size
+            except OSError:
+                continue
+            flist.append((os.path.join(prefix, name), size))
+    def _build_file_list(self, check_subdirs):
+        flist = []
+        try:
+            self._scan_dir(self.sdcard_dirname, check_subdirs, flist)
+        except OSError:
+            if check_subdirs:
+                return []
+            logging.exception("virtual_sdcard get_file_list")
+            raise self.gcode.error("Unable to get file list")
+        return sorted(flist, key=lambda f: f[0].lower())
     def get_status(self, eventtime):
         return {
             'file_path': self.file_path(),
@@ -113,8 +157,12 @@ class VirtualSD:
     def do_pause(self):
         if self.work_timer is not None:
             self.must_pause_work = True
-            while self.work_timer is not None and not self.cmd_from_sd:
-                self.reactor.pause(self.reactor.monotonic() + .001)
+            if self.cmd_from_sd:
+                return
+            # Wait for work_handler() to exit
+            if self.pause_completion is None:
+                self.pause_completion = self.reactor.completion()
+            self.pause_completion.wait()
     def do_resume(self):
         if self.work_timer is not None:
             logging.error("do_resume work_timer is not None")
@@ -184,13 +232,27 @@ class VirtualSD:
         if filename.startswith('/'):
             filename = filename[1:]
         self._load_file(gcmd, filename)
+    def _is_listed_file(self, filename, check_subdirs):
+        # Check if filename would appear as-is in get_file_list()
+        if check_subdirs:
+            if filename[filename.rfind('.')+1:] not in VALID_GCODE_EXTS:
+                return False
+            full_path = os.path.normpath(
+                os.path.join(self.sdcard_dirname, filename))
+            if not full_path.startswith(self.sdcard_dirname + os.sep):
+                return False
+        elif filename.startswith('.') or os.sep in filename:
+            return False
+        return os.path.isfile(os.path.join(self.sdcard_dirname, filename))
     def _load_file(self, gcmd, filename, check_subdirs=False):
-        files = self.get_file_list(check_subdirs)
-        flist = [f[0] for f in files]
-        files_by_lower = { fname.lower(): fname for fname, fsize in files }
+        files_by_lower = None
+        if not self._is_listed_file(filename, check_subdirs):
+            # Fall back to a case-insensitive search of the file list
+            files = self.get_file_list(check_subdirs)
+            files_by_lower = { fname.lower(): fname for fname, fsize in files }
         fname = filename
         try:
-            if fname not in flist:
+            if files_by_lower is not None:
                 fname = files_by_lower[fname.lower()]
             fname = os.path.join(self.sdcard_dirname, fname)
             f = open(fname, 'r')
@@ -201,6 +263,12 @@ class VirtualSD:
             # logging.exception("virtual_sdcard file open")
             logging.exception(e)
             raise gcmd.error("""{"code":"key121", "msg": "Unable to open file", "values": []}""")
+        if hasattr(os, 'posix_fadvise'):
+            # Hint the kernel to use aggressive readahead
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except (OSError, IOError):
+                pass
         gcmd.respond_raw("File opened:%s Size:%d" % (filename, fsize))
         gcmd.respond_raw("File selected")
         self.current_file = f
@@ -233,14 +301,21 @@ class VirtualSD:
         self.next_file_position = pos
     def is_cmd_from_sd(self):
         return self.cmd_from_sd
+    def _load_timelapse_config(self):
+        # Only parse the timelapse settings again if the file changed
+        st = os.stat(TIMELAPSE_CONFIG)
+        key = (st.st_mtime, st.st_size)
+        if self.timelapse_config is None or self.timelapse_config[0] != key:
+            import yaml
+            loader = getattr(yaml, 'CLoader', yaml.Loader)
+            with open(TIMELAPSE_CONFIG) as f:
+                self.timelapse_config = (key, yaml.load(f, Loader=loader))
+        return self.timelapse_config[1]
     # Background work timer
     def work_handler(self, eventtime):
-        import time
         # When the nozzle is moved
         try:
-            import yaml
-            with open("/mnt/UDISK/.crealityprint/time_lapse.yaml") as f:
-                config_data = yaml.load(f.read(), Loader=yaml.Loader)
+            config_data = self._load_timelapse_config()
             # if timelapse_position == 1 then When the nozzle is moved
             timelapse_postion = int(config_data.get('1').get("position", 0))
             enable_delay_photography = config_data.get('1').get("enable_delay_photography", False)
@@ -256,7 +331,7 @@ class VirtualSD:
             enable_delay_photography = False
 
         layer_count = 0
-        video0_status = True
+        timelapse_active = enable_delay_photography == True
         logging.info("get enable_delay_photography:%s timelapse position is %s" % (enable_delay_photography, timelapse_postion))
         logging.info("Starting SD card print (position %d)", self.file_position)
 
@@ -265,18 +340,18 @@ class VirtualSD:
             self.current_file.seek(self.file_position)
         except:
             logging.exception("virtual_sdcard seek")
-            self.work_timer = None
+            self._work_done()
             return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
         partial_input = ""
-        lines = []
+        lines = collections.deque()
         error_message = None
         while not self.must_pause_work:
             if not lines:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    data = self.current_file.read(131072)
                 except:
                     logging.exception("virtual_sdcard read")
                     break
@@ -290,7 +365,7 @@ class VirtualSD:
                 lines = data.split('\n')
                 lines[0] = partial_input + lines[0]
                 partial_input = lines.pop()
-                lines.reverse()
+                lines = collections.deque(lines)
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
@@ -299,59 +374,56 @@ class VirtualSD:
                 continue
             # Dispatch command
             self.cmd_from_sd = True
-            line = lines.pop()
+            line = lines.popleft()
             next_file_position = self.file_position + len(line) + 1
             self.next_file_position = next_file_position
             try:
                 # logging.info(line)
-                if enable_delay_photography == True and video0_status == True:
-                    for layer_key in LAYER_KEYS:
-                        if line.startswith(layer_key):
-                            if layer_count % int(frequency) == 0:
-                                if not os.path.exists("/dev/video0"):
-                                    video0_status = False
-                                    continue
-                                line = "TIMELAPSE_TAKE_FRAME"
-                                # logging.info("timelapse_postion: %d" % timelapse_postion)
-                                # logging.info(line)
-                                # if timelapse_postion:
-                                #     toolhead = self.printer.lookup_object('toolhead')
-                                #     X, Y, Z, E = toolhead.get_position()
-                                #     # 1. Pull back and lift first
-                                #     cmd_list1 = ["M83", "G1 E-4", "M82"]
-                                #     for sub_cmd in cmd_list1:
-                                #         logging.info(sub_cmd)
-                                #         self.gcode.run_script(sub_cmd)
-                                #     time.sleep(0.8)
-                                #     cmd_list2 = ["G91", "G1 Z2", "G90"]
-                                #     for sub_cmd in cmd_list2:
-                                #         logging.info(sub_cmd)
-                                #         self.gcode.run_script(sub_cmd)
-                                #     time.sleep(0.4)
-                                #
-                                #     # 2. move to the specified position
-                                #     cmd = "G0 X5 Y150 F9000"
-                                #     logging.info(cmd)
-                                #     self.gcode.run_script(cmd)
-                                #     cmd_wait_for_stepper = "M400"
-                                #     logging.info(cmd_wait_for_stepper)
-                                #     self.gcode.run_script(cmd_wait_for_stepper)
-                                #
-                                #     # 3. move back
-                                #     # cmd_list3 = ["M83", "G1 E3", "M82"]
-                                #     # for sub_cmd in cmd_list3:
-                                #     #     logging.info(sub_cmd)
-                                #     #     self.gcode.run_script(sub_cmd)
-                                #     time.sleep(0.4)
-                                #     cmd_list4 = ["G91", "G1 Z-2", "G90"]
-                                #     for sub_cmd in cmd_list4:
-                                #         logging.info(sub_cmd)
-                                #         self.gcode.run_script(sub_cmd)
-                                #     move_back_cmd = "G1 X%s Y%s Z%s F10000" % (X, Y, Z)
-                                #     logging.info(move_back_cmd)
-                                #     self.gcode.run_script(move_back_cmd)
-                            layer_count += 1
-                            break
+                if timelapse_active and line.startswith(LAYER_PREFIXES):
+                    if layer_count % frequency == 0:
+                        if os.path.exists("/dev/video0"):
+                            line = "TIMELAPSE_TAKE_FRAME"
+                            # logging.info("timelapse_postion: %d" % timelapse_postion)
+                            # logging.info(line)
+                            # if timelapse_postion:
+                            #     toolhead = self.printer.lookup_object('toolhead')
+                            #     X, Y, Z, E = toolhead.get_position()
+                            #     # 1. Pull back and lift first
+                            #     cmd_list1 = ["M83", "G1 E-4", "M82"]
+                            #     for sub_cmd in cmd_list1:
+                            #         logging.info(sub_cmd)
+                            #         self.gcode.run_script(sub_cmd)
+                            #     time.sleep(0.8)
+                            #     cmd_list2 = ["G91", "G1 Z2", "G90"]
+                            #     for sub_cmd in cmd_list2:
+                            #         logging.info(sub_cmd)
+                            #         self.gcode.run_script(sub_cmd)
+                            #     time.sleep(0.4)
+                            #
+                            #     # 2. move to the specified position
+                            #     cmd = "G0 X5 Y150 F9000"
+                            #     logging.info(cmd)
+                            #     self.gcode.run_script(cmd)
+                            #     cmd_wait_for_stepper = "M400"
+                            #     logging.info(cmd_wait_for_stepper)
+                            #     self.gcode.run_script(cmd_wait_for_stepper)
+                            #
+                            #     # 3. move back
+                            #     # cmd_list3 = ["M83", "G1 E3", "M82"]
+                            #     # for sub_cmd in cmd_list3:
+                            #     #     logging.info(sub_cmd)
+                            #     #     self.gcode.run_script(sub_cmd)
+                            #     time.sleep(0.4)
+                            #     cmd_list4 = ["G91", "G1 Z-2", "G90"]
+                            #     for sub_cmd in cmd_list4:
+                            #         logging.info(sub_cmd)
+                            #         self.gcode.run_script(sub_cmd)
+                            #     move_back_cmd = "G1 X%s Y%s Z%s F10000" % (X, Y, Z)
+                            #     logging.info(move_back_cmd)
+                            #     self.gcode.run_script(move_back_cmd)
+                        else:
+                            timelapse_active = False
+                    layer_count += 1
                 self.gcode.run_script(line)
             except self.gcode.error as e:
                 error_message = str(e)
@@ -367,13 +439,13 @@ class VirtualSD:
                     self.current_file.seek(self.file_position)
                 except:
                     logging.exception("virtual_sdcard seek")
-                    self.work_timer = None
+                    self._work_done()
                     return self.reactor.NEVER
-                lines = []
+                lines.clear()
                 partial_input = ""
         logging.info("Exiting SD card print (position %d)", self.file_position)
 
-        self.work_timer = None
+        self._work_done()
         self.cmd_from_sd = False
         if error_message is not None:
             self.print_stats.note_error(error_message)
@@ -384,14 +456,19 @@ class VirtualSD:
             self.print_stats.note_pause()
         else:
             self.print_stats.note_complete()
-            import threading
             t = threading.Thread(target=self._last_reset_file)
             t.start()
         return self.reactor.NEVER
 
+    def _work_done(self):
+        self.work_timer = None
+        completion = self.pause_completion
+        if completion is not None:
+            self.pause_completion = None
+            completion.complete(True)
+
     def _last_reset_file(self):
         logging.info("will use _last_rest_file after 5s...")
-        import time
         time.sleep(5)
         logging.info("use _last_rest_file")
         self._reset_file()
@@ -423,7 +500,7 @@ class VirtualSD:
             with open(_config_file, 'w+') as f:
                 yaml.dump(data, f, allow_unicode=True)
                 f.flush()
-            os.system("sync")
+                os.fsync(f.fileno())
         except Exception as e:
             pass
 
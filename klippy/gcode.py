@@ -209,7 +209,7 @@ class GCodeDispatch:
                 handler(gcmd)
             except self.error as e:
                 self._respond_error(str(e))
-                self.printer.send_event("gcode:command_error")
+                self.printer.fire_event("gcode:command_error")
                 if not need_ack:
                     raise
             except:
@@ -337,7 +337,7 @@ class GCodeDispatch:
             print_time = toolhead.get_last_move_time()
             if result == 'exit':
                 logging.info("Exiting (print time %.3fs)" % (print_time,))
-            self.printer.send_event("gcode:request_restart", print_time)
+            self.printer.fire_event("gcode:request_restart", print_time)
             toolhead.dwell(0.500)
             toolhead.wait_moves()
         self.printer.request_exit(result)
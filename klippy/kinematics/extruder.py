@@ -218,7 +218,7 @@ class PrinterExtruder:
         gcmd.respond_info("Activating extruder %s" % (self.name,))
         toolhead.flush_step_generation()
         toolhead.set_extruder(self, self.stepper.get_commanded_position())
-        self.printer.send_event("extruder:activate_extruder")
+        self.printer.fire_event("extruder:activate_extruder")
 
 # Dummy extruder class used when a printer has no extruder at all
 class DummyExtruder:
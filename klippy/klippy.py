@@ -4,7 +4,8 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, os, gc, optparse, logging, time, collections, importlib
+import sys, os, gc, optparse, logging, time, collections, importlib, json
+import shutil
 import util, reactor, queuelogger, msgproto
 import gcode, configfile, pins, mcu, toolhead, webhooks
 
@@ -42,10 +43,53 @@ FIRMWARE_RESTART command to reset the firmware, reload the
 config, and restart the host software.
 Printer is shutdown
 """
+message_shutdown_html = message_shutdown.replace("\n", "<br/>")
+
+def _format_json_error(emsg):
+    try:
+        state = json.loads(emsg)
+        state["msg"] = state["msg"] + "\n" + message_restart
+        return json.dumps(state)
+    except Exception as e:
+        logging.exception(e)
+        return "%s\n%s" % (str(e), message_restart)
+
+def _strip_error_prefix(emsg, prefix):
+    before, sep, after = emsg.partition(prefix)
+    return (before + after).replace("'*\n'", "'*\\n'")
+
+def _format_no_section_error(emsg):
+    value = _strip_error_prefix(emsg, "File contains no section headers.")
+    return """{"code": "key336", "msg": "File contains no section headers.<br/>%s", "values":["%s"]}""" % (
+        value, value)
+
+def _format_parsing_error(emsg):
+    value = _strip_error_prefix(emsg, "File contains parsing errors:")
+    return """{"code": "key337", "msg": "File contains parsing errors:%s<br/>%s", "values":["%s"]}""" % (
+        value, message_restart, value)
+
+# Config error messages and the state message formatter for each
+config_error_formats = (
+    ('{"code":', _format_json_error),
+    ("File contains no section headers.", _format_no_section_error),
+    ("File contains parsing errors:", _format_parsing_error),
+)
 
 api_server_index = None
+KLIPPY_DIR = os.path.dirname(os.path.abspath(__file__))
 MULTI_PRINTER_PATH = "/mnt/UDISK/.crealityprint/multiprinter.yaml"
 
+yaml_info = None
+def get_yaml():
+    # PyYAML is optional - import it, and pick the fastest available
+    # loader and dumper, on first use
+    global yaml_info
+    if yaml_info is None:
+        import yaml
+        yaml_info = (yaml, getattr(yaml, 'CLoader', yaml.Loader),
+                     getattr(yaml, 'CDumper', yaml.Dumper))
+    return yaml_info
+
 class Printer:
     config_error = configfile.error
     command_error = gcode.CommandError
@@ -59,6 +103,8 @@ class Printer:
         self.run_result = None
         self.event_handlers = {}
         self.objects = collections.OrderedDict()
+        self.objects_by_prefix = {}
+        self.extras_modules = self._find_extras_modules()
         # Init printer components that must be setup prior to config
         for m in [gcode, webhooks]:
             m.add_early_printer_objects(self)
@@ -88,6 +134,12 @@ class Printer:
         if name in self.objects:
             raise self.config_error(
                 """{"code":"key123", "msg": "Printer object '%s' already created", "values": ["%s"]}""" % (name, name))
+        self._store_object(name, obj)
+    def _store_object(self, name, obj):
+        # Index "module name" objects by their module for lookup_objects()
+        prefix = name.split(' ', 1)[0]
+        if prefix != name and name not in self.objects:
+            self.objects_by_prefix.setdefault(prefix, []).append(name)
         self.objects[name] = obj
     def lookup_object(self, name, default=configfile.sentinel):
         if name in self.objects:
@@ -96,40 +148,48 @@ class Printer:
             raise self.config_error("""{"code":"key122", "msg": "Unknown config object '%s'", "values": ["%s"]}""" % (name, name))
         return default
     def lookup_objects(self, module=None):
+        return list(self.iter_objects(module))
+    def iter_objects(self, module=None):
+        objects = self.objects
         if module is None:
-            return list(self.objects.items())
-        prefix = module + ' '
-        objs = [(n, self.objects[n])
-                for n in self.objects if n.startswith(prefix)]
-        if module in self.objects:
-            return [(module, self.objects[module])] + objs
-        return objs
+            for item in objects.items():
+                yield item
+            return
+        if module in objects:
+            yield module, objects[module]
+        if ' ' in module:
+            prefix = module + ' '
+            names = [n for n in objects if n.startswith(prefix)]
+        else:
+            names = self.objects_by_prefix.get(module, ())
+        for n in names:
+            yield n, objects[n]
+    def _find_extras_modules(self):
+        # Scan the extras directory once instead of probing per section
+        return set(find_modules(os.path.join(KLIPPY_DIR, 'extras')))
     def load_object(self, config, section, default=configfile.sentinel):
         if section in self.objects:
             return self.objects[section]
         module_parts = section.split()
         module_name = module_parts[0]
-        py_name = os.path.join(os.path.dirname(__file__),
-                               'extras', module_name + '.py')
-        py_dirname = os.path.join(os.path.dirname(__file__),
-                                  'extras', module_name, '__init__.py')
-        if not os.path.exists(py_name) and not os.path.exists(py_dirname):
+        if module_name not in self.extras_modules:
             if default is not configfile.sentinel:
                 return default
             raise self.config_error("""{"code":"key124", "msg": "Unable to load module '%s'", "values": ["%s"]}""" % (section, section))
         mod = importlib.import_module('extras.' + module_name)
-        init_func = 'load_config'
         if len(module_parts) > 1:
-            init_func = 'load_config_prefix'
-        init_func = getattr(mod, init_func, None)
+            init_func = getattr(mod, 'load_config_prefix', None)
+        else:
+            init_func = getattr(mod, 'load_config', None)
         if init_func is None:
             if default is not configfile.sentinel:
                 return default
             raise self.config_error("Unable to load module '%s'" % (section,))
-        self.objects[section] = init_func(config.getsection(section))
+        self._store_object(section, init_func(config.getsection(section)))
         return self.objects[section]
     def _read_config(self):
-        self.objects['configfile'] = pconfig = configfile.PrinterConfig(self)
+        pconfig = configfile.PrinterConfig(self)
+        self._store_object('configfile', pconfig)
         config = pconfig.read_main_config()
         if self.bglogger is not None:
             pconfig.log_config(config)
@@ -145,7 +205,7 @@ class Printer:
     def _get_versions(self):
         try:
             parts = ["%s=%s" % (n.split()[-1], m.get_status()['mcu_version'])
-                     for n, m in self.lookup_objects('mcu')]
+                     for n, m in self.iter_objects('mcu')]
             parts.insert(0, "host=%s" % (self.start_args['software_version'],))
             return "\nKnown versions: %s\n" % (", ".join(parts),)
         except:
@@ -154,7 +214,7 @@ class Printer:
     def _connect(self, eventtime):
         try:
             self._read_config()
-            self.send_event("klippy:mcu_identify")
+            self.fire_event("klippy:mcu_identify")
             for cb in self.event_handlers.get("klippy:connect", []):
                 if self.state_message is not message_startup:
                     return
@@ -163,49 +223,29 @@ class Printer:
             # logging.exception("Config error")^M
             logging.error(e)
             # self._set_state("%s\n%s" % (str(e), message_restart))^M
-            if '{"code":' in str(e):
-                try:
-                    import json
-                    tmp_state = eval(str(e))
-                    tmp_state["msg"] = tmp_state["msg"] + "\n" + message_restart
-                    self._set_state(json.dumps(tmp_state))
-                except Exception as e:
-                    logging.exception(e)
-                    self._set_state("%s\n%s" % (str(e), message_restart))
+            emsg = str(e)
+            for pattern, format_error in config_error_formats:
+                if pattern in emsg:
+                    self._set_state(format_error(emsg))
+                    break
             else:
-                if "File contains no section headers." in str(e):
-                    value = str(e)
-                    value = value.replace("File contains no section headers.", "").replace("'*\n'", "'*\\n'")
-
-                    msg = """{"code": "key336", "msg": "File contains no section headers.<br/>%s", "values":["%s"]}""" % (
-                        value, value
-                    )
-                    self._set_state(msg)
-                elif "File contains parsing errors:" in str(e):
-                    value = str(e)
-                    value = value.replace("File contains parsing errors:", "").replace("'*\n'", "'*\\n'")
-
-                    msg = """{"code": "key337", "msg": "File contains parsing errors:%s<br/>%s", "values":["%s"]}""" % (
-                        value, message_restart, value
-                    )
-                    self._set_state(msg)
-                else:
-                    self._set_state("%s\n%s" % (str(e), message_restart))
+                self._set_state("%s\n%s" % (emsg, message_restart))
             logging.exception("Config error")
             return
         except msgproto.error as e:
             logging.exception("Protocol error")
-            self._set_state("%s\n%s%s%s" % (str(e), message_protocol_error1,
-                                          self._get_versions(),
-                                          message_protocol_error2))
+            self._set_state("".join((str(e), "\n", message_protocol_error1,
+                                     self._get_versions(),
+                                     message_protocol_error2)))
             util.dump_mcu_build()
             return
         except mcu.error as e:
             logging.exception("MCU error during connect")
-            if '"msg"' in str(e):
-                json_msg = str(e)
+            emsg = str(e)
+            if '"msg"' in emsg:
+                json_msg = emsg
             else:
-                json_msg = '{"code":"key0", "msg":"%s%s"}' % (str(e), message_mcu_connect_error)
+                json_msg = '{"code":"key0", "msg":"%s%s"}' % (emsg, message_mcu_connect_error)
             self._set_state(json_msg)
             util.dump_mcu_build()
             return
@@ -222,6 +262,7 @@ class Printer:
                 if self.state_message is not message_ready:
                     return
                 cb()
+            self._freeze_event_handlers()
         except Exception as e:
             logging.exception("Unhandled exception during ready callback")
             self.invoke_shutdown("Internal error during ready callback: %s"
@@ -250,9 +291,9 @@ class Printer:
         run_result = self.run_result
         try:
             if run_result == 'firmware_restart':
-                for n, m in self.lookup_objects(module='mcu'):
+                for n, m in self.iter_objects(module='mcu'):
                     m.microcontroller_restart()
-            self.send_event("klippy:disconnect")
+            self.fire_event("klippy:disconnect")
         except:
             logging.exception("Unhandled exception during post run")
         return run_result
@@ -266,14 +307,14 @@ class Printer:
         """
         read yaml file info
         """
-        import yaml
+        yaml, loader, dumper = get_yaml()
         # if not _config_file:
         if not os.path.exists(_config_file):
             return {}
         config_data = {}
         try:
             with open(_config_file, 'r') as f:
-                config_data = yaml.load(f.read(), Loader=yaml.Loader)
+                config_data = yaml.load(f, Loader=loader)
         except Exception as err:
             pass
         return config_data
@@ -282,14 +323,15 @@ class Printer:
         """
         write yaml file info
         """
-        import yaml
+        yaml, loader, dumper = get_yaml()
         if not _config_file:
             return
         try:
             with open(_config_file, 'w+') as f:
-                yaml.dump(data, f, allow_unicode=True)
+                yaml.dump(data, f, Dumper=dumper,
+                          allow_unicode=True)
                 f.flush()
-            os.system("sync")
+                os.fsync(f.fileno())
         except Exception as e:
             pass
 
@@ -303,7 +345,7 @@ class Printer:
         if "{" in msg:
             result = msg
         else:
-            result = '{"code":"key1", "msg":"%s%s"}' % (msg, message_shutdown.replace("\n","<br/>"))
+            result = '{"code":"key1", "msg":"%s%s"}' % (msg, message_shutdown_html)
         self._set_state(result)
         for cb in self.event_handlers.get("klippy:shutdown", []):
             try:
@@ -316,9 +358,24 @@ class Printer:
         self.reactor.register_async_callback(
             (lambda e: self.invoke_shutdown(msg)))
     def register_event_handler(self, event, callback):
-        self.event_handlers.setdefault(event, []).append(callback)
+        handlers = self.event_handlers.setdefault(event, [])
+        # Registering the same callback again would only repeat its work
+        if callback in handlers:
+            return
+        if type(handlers) is tuple:
+            self.event_handlers[event] = handlers + (callback,)
+        else:
+            handlers.append(callback)
+    def _freeze_event_handlers(self):
+        # Handlers rarely change once ready - store them as tuples
+        for event, handlers in self.event_handlers.items():
+            self.event_handlers[event] = tuple(handlers)
     def send_event(self, event, *params):
         return [cb(*params) for cb in self.event_handlers.get(event, [])]
+    def fire_event(self, event, *params):
+        # Like send_event(), but for callers that ignore the results
+        for cb in self.event_handlers.get(event, ()):
+            cb(*params)
     def request_exit(self, result):
         if self.run_result is None:
             self.run_result = result
@@ -329,18 +386,24 @@ class Printer:
 # Startup
 ######################################################################
 
+def find_modules(dname):
+    # Return the names of the modules and packages in a directory
+    modules = []
+    # Use the directory entry types to avoid a stat() of every file
+    for entry in util.scandir(dname):
+        fname = entry.name
+        if fname.endswith('.py'):
+            if fname != '__init__.py':
+                modules.append(fname[:-3])
+        elif (entry.is_dir()
+              and os.path.exists(os.path.join(entry.path, '__init__.py'))):
+            modules.append(fname)
+    return modules
+
 def import_test():
     # Import all optional modules (used as a build test)
-    dname = os.path.dirname(__file__)
     for mname in ['extras', 'kinematics']:
-        for fname in os.listdir(os.path.join(dname, mname)):
-            if fname.endswith('.py') and fname != '__init__.py':
-                module_name = fname[:-3]
-            else:
-                iname = os.path.join(dname, mname, fname, '__init__.py')
-                if not os.path.exists(iname):
-                    continue
-                module_name = fname
+        for module_name in find_modules(os.path.join(KLIPPY_DIR, mname)):
             importlib.import_module(mname + '.' + module_name)
     sys.exit(0)
 
@@ -353,6 +416,17 @@ def arg_dictionary(option, opt_str, value, parser):
         parser.values.dictionary = {}
     parser.values.dictionary[key] = fname
 
+def copy_file_synced(src, dst):
+    try:
+        shutil.copyfile(src, dst)
+        fd = os.open(dst, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except (IOError, OSError):
+        logging.exception("Unable to copy %s to %s", src, dst)
+
 def main():
     # printer_cfg_obj = "/mnt/UDISK/printer_config/printer.cfg"
     # if not os.path.exists(printer_cfg_obj) or os.path.getsize(printer_cfg_obj) == 0:
@@ -393,7 +467,9 @@ def main():
             api_server_index = "1"
             timelapse_cfg_obj = "/mnt/UDISK/printer_config/timelapse.cfg"
         if not os.path.exists(timelapse_cfg_obj):
-            os.system("/bin/cp /usr/share/klipper-brain/printer_config/timelapse.cfg %s && sync" % timelapse_cfg_obj)
+            copy_file_synced(
+                "/usr/share/klipper-brain/printer_config/timelapse.cfg",
+                timelapse_cfg_obj)
 
         with open("/mnt/UDISK/.crealityprint/printer%s_stat" % api_server_index, "w+") as f:
             logging.info("/mnt/UDISK/.crealityprint/printer%s_stat set init invoke_shutdown status" % api_server_index)
@@ -443,15 +519,20 @@ def main():
         if bglogger is not None:
             bglogger.clear_rollover_info()
             bglogger.set_rollover_info('versions', versions)
-        gc.collect()
         main_reactor = reactor.Reactor(gc_checking=True)
         printer = Printer(main_reactor, bglogger, start_args)
+        start_time = main_reactor.monotonic()
         res = printer.run()
         if res in ['exit', 'error_exit']:
             break
-        time.sleep(1.)
+        # Throttle restart loops and give a reset mcu time to come back
+        if (res == 'firmware_restart'
+            or main_reactor.monotonic() - start_time < 5.):
+            time.sleep(1.)
         main_reactor.finalize()
         main_reactor = printer = None
+        # Free the previous printer's objects before building a new one
+        gc.collect()
         logging.info("Restarting printer")
         start_args['start_reason'] = res
 
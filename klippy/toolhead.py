@@ -310,7 +310,7 @@ class ToolHead:
         min_print_time = max(est_print_time + self.buffer_time_start, kin_time)
         if min_print_time > self.print_time:
             self.print_time = min_print_time
-            self.printer.send_event("toolhead:sync_print_time",
+            self.printer.fire_event("toolhead:sync_print_time",
                                     curtime, est_print_time, self.print_time)
     def _process_moves(self, moves):
         # Resync print_time if necessary
@@ -416,7 +416,7 @@ class ToolHead:
                                    newpos[0], newpos[1], newpos[2])
         self.commanded_pos[:] = newpos
         self.kin.set_position(newpos, homing_axes)
-        self.printer.send_event("toolhead:set_position")
+        self.printer.fire_event("toolhead:set_position")
     def move(self, newpos, speed):
         move = Move(self, self.commanded_pos, newpos, speed)
         if not move.move_d:
@@ -435,7 +435,7 @@ class ToolHead:
             if coord[i] is not None:
                 curpos[i] = coord[i]
         self.move(curpos, speed)
-        self.printer.send_event("toolhead:manual_move")
+        self.printer.fire_event("toolhead:manual_move")
     def dwell(self, delay):
         next_print_time = self.get_last_move_time() + max(0., delay)
         self._update_move_time(next_print_time)
@@ -105,6 +105,23 @@ def setup_python2_wrappers():
     time.process_time = time.clock
 setup_python2_wrappers()
 
+try:
+    from os import scandir
+except ImportError:
+    # Python2 has no os.scandir() - emulate the parts used by klippy
+    class _DirEntry:
+        def __init__(self, dirpath, name):
+            self.name = name
+            self.path = os.path.join(dirpath, name)
+        def is_dir(self):
+            return os.path.isdir(self.path)
+        def is_file(self):
+            return os.path.isfile(self.path)
+        def stat(self):
+            return os.stat(self.path)
+    def scandir(dirpath):
+        return [_DirEntry(dirpath, name) for name in os.listdir(dirpath)]
+
 
 ######################################################################
 # General system and software information